@@ -0,0 +1,82 @@
+"""Benchmark the setup of experiment workspaces with large deps.
+
+Compare the time it takes to create an experiment workspace and check out its deps
+from the shared DVC cache for different 'cache.type' settings, e.g.
+
+    python benchmarks/workspace_setup.py --size 2048 --repeat 3
+"""
+import argparse
+import dataclasses
+import os
+import pathlib
+import subprocess
+import tempfile
+import time
+import typing
+
+import dvc.cli
+import dvc.repo
+import git
+from dvc.repo.experiments.queue import tasks
+
+from dask4dvc import dvc_repro
+
+# 'None' keeps the DVC default, which is 'reflink,copy'
+CACHE_TYPES = ["copy", None, "hardlink", "symlink"]
+
+
+def create_repo(path: pathlib.Path, size: int) -> None:
+    """Create a DVC repo with a single stage depending on a large file of 'size' MB."""
+    os.chdir(path)
+    git.Repo.init()
+    assert dvc.cli.main(["init", "--quiet"]) == 0
+    with open("data.bin", "wb") as file:
+        for _ in range(size):
+            file.write(os.urandom(1024 * 1024))
+    assert dvc.cli.main(["add", "--quiet", "data.bin"]) == 0
+    assert dvc.cli.main(["stage", "add", "-n", "stage", "-d", "data.bin", "true"]) == 0
+
+    repo = git.Repo()
+    repo.git.add(all=True)
+    repo.index.commit("Initial Commit")
+
+
+def time_workspace_setup(cache_type: typing.Optional[str]) -> float:
+    """Set up an experiment workspace and check out the deps into it."""
+    name = f"benchmark-{cache_type}-{time.time_ns()}"
+    assert dvc.cli.main(["exp", "run", "--queue", "--name", name, "stage"]) == 0
+    entry, infofile = dvc_repro.get_all_queue_entries(dvc.repo.Repo())[name]
+
+    start = time.perf_counter()
+    executor = tasks.setup_exp(entry_dict=dataclasses.asdict(entry))
+    try:
+        if cache_type is not None:
+            dvc_repro.set_cache_type(
+                os.path.join(executor.root_dir, executor.dvc_dir),
+                dvc_repro.get_cache_type(cache_type),
+            )
+        subprocess.check_call(["dvc", "checkout", "--quiet"], cwd=executor.root_dir)
+        return time.perf_counter() - start
+    finally:
+        executor.cleanup(infofile)
+        dvc_repro.remove_experiments([name])
+
+
+def main() -> None:
+    """Run the benchmark and print the mean setup time per 'cache.type'."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=1024, help="size of the dep in MB")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        create_repo(pathlib.Path(tmp_dir), args.size)
+        for cache_type in CACHE_TYPES:
+            times = [time_workspace_setup(cache_type) for _ in range(args.repeat)]
+            print(
+                f"cache.type={cache_type or 'default'}: {sum(times) / len(times):.3f} s"
+            )
+
+
+if __name__ == "__main__":
+    main()
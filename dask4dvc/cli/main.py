@@ -1,18 +1,27 @@
 """All methods that come directly from 'dask4dvc' CLI interface."""
 
+import contextlib
 import importlib.metadata
 import logging
 import subprocess
 import typing
 import webbrowser
 
+import dask.config
 import dask.distributed
 import dvc.cli
 import dvc.repo
 import typer
+import voluptuous
 
-from dask4dvc import dvc_repro
-from dask4dvc.utils.dask import get_cluster_from_config, wait_for_futures
+from dask4dvc import dvc_repro, dvc_transport
+from dask4dvc.utils.dask import (
+    get_cluster_from_config,
+    get_memory_resources,
+    wait_for_futures,
+)
+from dask4dvc.utils.graph import get_stage_graph
+from dask4dvc.utils.memory import load_peak_memory
 
 app = typer.Typer()
 
@@ -33,6 +42,59 @@ class Help:
         " slower."
     )
     dashboard: str = "Open Dask Dashboard in Browser"
+    cache_type: str = (
+        "Link type(s) used to check out deps and outputs in the experiment workspaces,"
+        " e.g. 'reflink,hardlink,symlink'. Falls back to 'copy' if none of them work."
+        " If 'None' the DVC config of the repository is used."
+    )
+    memory_resources: str = (
+        "Request the peak memory measured in earlier runs of each stage as the dask"
+        " resource 'memory'. The workers must provide it, e.g. via 'dask-worker"
+        " --resources memory=16e9'."
+    )
+    in_process: str = (
+        "Run the stages in processes forked from a forkserver with DVC and ZnTrack"
+        " already imported instead of starting 'dvc' and 'zntrack' for every stage."
+        " Workers of external clusters need 'distributed.worker.daemon: False'."
+    )
+    preload: str = (
+        "Additional module to import in the forkserver of '--in-process', e.g."
+        " 'numpy'. Do not use it for modules of the repository itself."
+    )
+    max_tasks: str = (
+        "Maximum number of stages or experiments that are submitted to the scheduler"
+        " at the same time. More are submitted as they finish. If 'None', all are"
+        " submitted at once."
+    )
+    transport: str = (
+        "Send the deps of each stage to the workers and run it in a local scratch"
+        " directory instead of relying on a filesystem shared with the workers."
+    )
+
+
+def _get_cache_type(cache_type: typing.Optional[str]) -> typing.Optional[str]:
+    """Validate the '--cache-type' option."""
+    if cache_type is None:
+        return None
+    try:
+        return dvc_repro.get_cache_type(cache_type)
+    except voluptuous.Invalid as err:
+        typer.echo(err)
+        raise typer.Exit(1) from err
+
+
+@contextlib.contextmanager
+def _get_client(
+    address: typing.Optional[str], config: typing.Optional[str], in_process: bool
+) -> typing.Iterator[dask.distributed.Client]:
+    """Connect to the given cluster or start a new one."""
+    # the workers must be allowed to start the forkserver
+    with dask.config.set({"distributed.worker.daemon": False} if in_process else {}):
+        if config is not None:
+            assert address is None, "Can not use address and config file"
+            address = get_cluster_from_config(config)
+        with dask.distributed.Client(address) as client:
+            yield client
 
 
 @app.command()
@@ -55,37 +117,73 @@ def repro(
         None, "-o", "--option", help="Additional dvc repro options"
     ),
     cleanup: bool = typer.Option(True, help="Remove temporary experiments when done"),
+    cache_type: str = typer.Option(None, help=Help.cache_type),
+    transport: bool = typer.Option(False, help=Help.transport),
+    memory_resources: bool = typer.Option(False, help=Help.memory_resources),
+    in_process: bool = typer.Option(False, help=Help.in_process),
+    preload: typing.List[str] = typer.Option(None, help=Help.preload),
+    max_tasks: int = typer.Option(None, min=1, help=Help.max_tasks),
 ) -> None:
     """Replicate 'dvc repro' command using dask."""
     if len(option) != 0:
         typer.echo("Additional dvc repro options are not implemented yet")
         raise typer.Exit(1)
 
-    repo = dvc.repo.Repo()
-    stages = dvc_repro.queue_consecutive_stages(repo, targets, option)
-
-    if config is not None:
-        assert address is None, "Can not use address and config file"
-        address = get_cluster_from_config(config)
+    cache_type = _get_cache_type(cache_type)
 
-    with dask.distributed.Client(address) as client:
-        dask.distributed.Variable("cleanup").set(cleanup)
-        dask.distributed.Variable("repro").set(True)
+    repo = dvc.repo.Repo()
+    graph = get_stage_graph(repo)
+    if not transport:
+        stages = dvc_repro.queue_consecutive_stages(repo, graph, targets, option)
+
+    with _get_client(address, config, in_process) as client:
+        dask.distributed.Variable("cache_type").set(cache_type)
+        dask.distributed.Variable("in_process").set(in_process)
+        dask.distributed.Variable("preload").set(list(preload or []))
         if dashboard:
             webbrowser.open(client.dashboard_link)
         if max_workers is not None:
             client.cluster.adapt(minimum=1, maximum=max_workers)
         log.info(client)
 
-        mapping = dvc_repro.parallel_submit(client, repo, stages)
-
-        wait_for_futures(client, mapping)
-        if all(x.status == "finished" for x in mapping.values()):
-            log.info("All stages finished successfully")
-            # dvc.cli.main(["exp", "apply", experiments[-1]])
-            dask.distributed.wait(
-                client.submit(subprocess.check_call, ["dvc", "repro", *targets])
+        resources = (
+            get_memory_resources(client, load_peak_memory(repo.root_dir))
+            if memory_resources
+            else None
+        )
+
+        if transport:
+            status = dvc_transport.transport_submit(
+                client,
+                repo,
+                graph,
+                targets,
+                resources,
+                preload=list(preload or []) if in_process else None,
+                max_tasks=max_tasks,
             )
+        else:
+            with dvc_repro.ExperimentCollector(cleanup, repro=True) as collector:
+                mapping = dvc_repro.parallel_submit(
+                    client,
+                    collector,
+                    repo,
+                    graph,
+                    stages,
+                    resources,
+                    max_tasks=max_tasks,
+                )
+                wait_for_futures(client, mapping)
+            status = {stage: future.status for stage, future in mapping.items()}
+
+        if all(x == "finished" for x in status.values()):
+            log.info("All stages finished successfully")
+            # with '--transport' the results are already in the workspace
+            if not transport:
+                # dvc.cli.main(["exp", "apply", experiments[-1]])
+                dask.distributed.wait(
+                    client.submit(subprocess.check_call, ["dvc", "repro", *targets])
+                )
 
         if not leave:
             _ = input("Press Enter to close the client")
@@ -101,29 +199,35 @@ def run(
     config: str = typer.Option(None, help=Help.config),
     max_workers: int = typer.Option(None, help=Help.max_workers),
     dashboard: bool = typer.Option(False, help=Help.dashboard),
+    cache_type: str = typer.Option(None, help=Help.cache_type),
+    in_process: bool = typer.Option(False, help=Help.in_process),
+    preload: typing.List[str] = typer.Option(None, help=Help.preload),
+    max_tasks: int = typer.Option(None, min=1, help=Help.max_tasks),
 ) -> None:
     """Replicate 'dvc queue start' using dask."""
     if len(targets) == 0:
         targets = None
 
-    repo = dvc.repo.Repo()
+    cache_type = _get_cache_type(cache_type)
 
-    if config is not None:
-        assert address is None, "Can not use address and config file"
-        address = get_cluster_from_config(config)
+    repo = dvc.repo.Repo()
 
-    with dask.distributed.Client(address) as client:
-        dask.distributed.Variable("cleanup").set(False)
-        dask.distributed.Variable("repro").set(False)
+    with _get_client(address, config, in_process) as client:
+        dask.distributed.Variable("cache_type").set(cache_type)
+        dask.distributed.Variable("in_process").set(in_process)
+        dask.distributed.Variable("preload").set(list(preload or []))
         if dashboard:
             webbrowser.open(client.dashboard_link)
         if max_workers is not None:
             client.cluster.adapt(minimum=1, maximum=max_workers)
         log.info(client)
 
-        mapping = dvc_repro.experiment_submit(client, repo, targets)
-
-        wait_for_futures(client, mapping)
+        with dvc_repro.ExperimentCollector(cleanup=False, repro=False) as collector:
+            status = dvc_repro.experiment_submit(
+                client, collector, repo, targets, max_tasks
+            )
+        if all(x == "finished" for x in status.values()):
+            log.info("All experiments finished successfully")
         # dvc_repro.remove_experiments(experiments)
 
         if not leave:
@@ -1,32 +1,178 @@
 """Dask4DVC to DVC repo interface."""
 import dataclasses
 import logging
-import subprocess
+import os
+import queue
+import threading
+import time
 import typing
 import uuid
 
 import dask.distributed
 import dvc.cli
+import dvc.config
 import dvc.repo
+from dvc.config_schema import supported_cache_type
+from dvc.dvcfile import PROJECT_FILE
+from dvc.repo.experiments.executor.base import ExecutorInfo
+from dvc.repo.experiments.executor.local import TempDirExecutor
 from dvc.repo.experiments.queue import tasks
-from dvc.repo.experiments.queue.base import QueueEntry
-from dvc.repo.reproduce import _get_steps
-from dvc.stage import PipelineStage
+from dvc.repo.experiments.queue.base import BaseStashQueue, QueueEntry
+from dvc.stage import Stage
+from dvc.stage.cache import RunCacheNotFoundError
+from dvc.utils import parse_target
+
+from dask4dvc.utils import forkserver
+from dask4dvc.utils.dask import wait_for_window
+from dask4dvc.utils.graph import StageGraph
+from dask4dvc.utils.memory import check_call_with_peak_rss, save_peak_memory
 
 log = logging.getLogger(__name__)
 
 
+def get_ordered_stages(
+    repo: dvc.repo.Repo, graph: StageGraph, targets: typing.List[str]
+) -> typing.List[str]:
+    """Get the stages to reproduce in topological order.
+
+    Parameters
+    ----------
+    repo : dvc.repo.Repo
+        The DVC repo to gather the stages from
+    graph : StageGraph
+        The stage graph of the repo, see 'get_stage_graph'.
+    targets : typing.List[str], optional
+        The stages to reproduce, by default it will use all stages in the DAG
+
+    Returns
+    -------
+    typing.List[str]
+        The addressing of the targets and all their upstream pipeline stages,
+        dependencies first.
+    """
+    if len(targets) == 0:
+        stages = list(graph.upstream)
+    else:
+        stages = [
+            x if x in graph.upstream else repo.stage.get_target(x).addressing
+            for x in targets
+        ]
+
+    pipeline_stages = set(graph.pipeline_stages)
+    ordered_stages = []
+    for stage in graph.get_steps(stages):
+        if stage in pipeline_stages:
+            ordered_stages.append(stage)
+        else:
+            log.warning(f"Skipping stage {stage} because it is not a pipeline stage")
+    return ordered_stages
+
+
+def restore_stage(repo: dvc.repo.Repo, stage: Stage) -> bool:
+    """Restore a stage from the run cache instead of running it.
+
+    Works like 'dvc repro' for a single stage whose command, deps and params were
+    run before: the outputs are checked out from the cache and 'dvc.lock' is
+    updated. Changed frozen stages are never restored.
+
+    Returns
+    -------
+    bool
+        Whether the stage did not change or was restored.
+    """
+    with repo.lock:
+        if not stage.changed():
+            return True
+        if stage.frozen:
+            return False
+        try:
+            repo.stage_cache.restore(stage)
+        except RunCacheNotFoundError:
+            return False
+        stage.save()
+        stage.dump(update_pipeline=False)
+    return True
+
+
+def load_stages(
+    repo: dvc.repo.Repo, stages: typing.Iterable[str]
+) -> typing.Dict[str, Stage]:
+    """Load the given pipeline stages.
+
+    Every pipeline file is parsed only once. Loading stage by stage with
+    'repo.stage.get_target' would parse the whole file again for every stage.
+
+    Parameters
+    ----------
+    repo : dvc.repo.Repo
+        The DVC repo of the stages.
+    stages : typing.Iterable[str]
+        The addressing of the stages, e.g. 'sub/dvc.yaml:stage'.
+
+    Returns
+    -------
+    typing.Dict[str, Stage]
+        The addressing of every requested stage mapped to the stage.
+    """
+    stages = set(stages)
+    files = {parse_target(addressing)[0] or PROJECT_FILE for addressing in stages}
+    loaded = {}
+    for file in sorted(files):
+        for stage in repo.stage.load_file(os.path.join(repo.root_dir, file)):
+            if stage.addressing in stages:
+                loaded[stage.addressing] = stage
+    return loaded
+
+
+def restore_cached_stages(
+    repo: dvc.repo.Repo, graph: StageGraph, stages: typing.List[str]
+) -> typing.List[str]:
+    """Restore all stages that can be found in the run cache.
+
+    Parameters
+    ----------
+    repo : dvc.repo.Repo
+        The DVC repo of the stages.
+    graph : StageGraph
+        The stage graph of the repo, see 'get_stage_graph'.
+    stages : typing.List[str]
+        The addressing of the stages in topological order, see 'get_ordered_stages'.
+
+    Returns
+    -------
+    typing.List[str]
+        The stages that still have to run, in the same order. Stages with an
+        upstream stage that has to run can not be looked up and are always included.
+    """
+    loaded = load_stages(repo, stages)
+    remaining, remaining_set = [], set()
+    for addressing in stages:
+        if remaining_set.isdisjoint(graph.upstream[addressing]):
+            if restore_stage(repo, loaded[addressing]):
+                log.info(f"Stage '{addressing}' is cached, skipping")
+                continue
+        remaining.append(addressing)
+        remaining_set.add(addressing)
+    return remaining
+
+
 def queue_consecutive_stages(
     repo: dvc.repo.Repo,
+    graph: StageGraph,
     targets: typing.List[str],
     options: list = None,
-) -> typing.Dict[PipelineStage, str]:
+) -> typing.Dict[str, str]:
     """Create an experiment for each stage in the DAG.
 
+    Stages that can be restored from the run cache are restored in the workspace
+    instead, see 'restore_cached_stages'.
+
     Parameters
     ----------
     repo : dvc.repo.Repo
         The DVC repo to gather the stages from
+    graph : StageGraph
+        The stage graph of the repo, see 'get_stage_graph'.
     targets : typing.List[str], optional
         The stages to queue, by default it will use all stages in the DAG
     options : list, optional
@@ -35,31 +181,27 @@ def queue_consecutive_stages(
 
     Returns
     -------
-    typing.Dict[PipelineStage, str]
-        A dictionary mapping each stage to its experiment name
+    typing.Dict[str, str]
+        A dictionary mapping the addressing of each stage to its experiment name
     """
-    if len(targets) == 0:
-        stages = repo.index.graph.nodes
-    else:
-        stages = [repo.stage.get_target(x) for x in targets]
-
-    ordered_stages = _get_steps(
-        repo.index.graph, stages, downstream=False, single_item=False
+    ordered_stages = restore_cached_stages(
+        repo, graph, get_ordered_stages(repo, graph, targets)
     )
 
-    experiment_names = {}
+    experiment_names = {
+        stage: f"{stage.rsplit(':', 1)[-1]}-dask4dvc-{str(uuid.uuid4())[:8]}"
+        for stage in ordered_stages
+    }
 
-    cmd = ["exp", "run", "--queue"]
-    if options is not None:
-        cmd.extend(options)
-    for stage in ordered_stages:
-        try:
-            name = f"{stage.name}-dask4dvc-{str(uuid.uuid4())[:8]}"
-            experiment_names[stage] = name
-            dvc.cli.main(cmd + ["--name", name, stage.name])
-        except AttributeError:
-            # has no attribute name
-            log.warning(f"Skipping stage {stage} because it is not a pipeline stage")
+    if options:
+        for stage, name in experiment_names.items():
+            dvc.cli.main(["exp", "run", "--queue", *options, "--name", name, stage])
+    else:
+        # DVC collects the index for every queued experiment and drops it when the
+        #  repository is unlocked. Keeping it locked, the index is only collected once.
+        with dvc.repo.lock_repo(repo):
+            for stage, name in experiment_names.items():
+                repo.experiments.run(targets=[stage], queue=True, name=name)
 
     return experiment_names
 
@@ -81,70 +223,266 @@ def get_all_queue_entries(
 def remove_experiments(experiments: typing.List[str] = None) -> None:
     """Remove queued experiments."""
     repo = dvc.repo.Repo()
-    queue = repo.experiments.celery_queue
-    found_experiments = []
-    for msg in queue.celery.iter_queued():
-        if msg.headers.get("task") != tasks.run_exp.name:
-            continue
-        args, kwargs, _embed = msg.decode()
-        entry_dict = kwargs.get("entry_dict", args[0])
-        if (experiments is None and "-dask4dvc-" in entry_dict["name"]) or (
-            experiments is not None and entry_dict["name"] in experiments
-        ):
-            found_experiments.append(entry_dict["name"])
-            queue.celery.reject(msg.delivery_tag)
+    found_experiments = reject_queued_experiments(
+        repo,
+        lambda name: (
+            "-dask4dvc-" in name if experiments is None else name in experiments
+        ),
+    )
     dvc.cli.main(["exp", "remove"] + found_experiments)
 
 
-def reproduce_experiment(entry_dict: dict, infofile: str, successors: list) -> str:
-    """Reproduce an experiment."""
+def get_cache_type(cache_type: str) -> str:
+    """Validate the given DVC link types and append 'copy' as a safe fallback.
+
+    Parameters
+    ----------
+    cache_type : str
+        Comma separated link types, e.g. 'reflink,hardlink,symlink'.
+
+    Returns
+    -------
+    str
+        The link types in the format of the DVC 'cache.type' config option.
+    """
+    link_types = supported_cache_type(cache_type)
+    if "copy" not in link_types:
+        link_types.append("copy")
+    return ",".join(link_types)
+
+
+def set_cache_type(dvc_dir: str, cache_type: str) -> None:
+    """Set the link type for checking out files in an experiment workspace.
+
+    The experiment workspaces already share the DVC cache with the main repository.
+    Using links instead of copies avoids duplicating large deps and outputs.
+    """
+    # only the config is needed, opening the workspace as a 'Repo' is much slower
+    with dvc.config.Config(dvc_dir).edit("local") as conf:
+        conf.setdefault("cache", {})["type"] = cache_type
+
+
+def reproduce_experiment(entry_dict: dict, infofile: str, successors: list) -> int:
+    """Reproduce an experiment.
+
+    The worker is released as soon as 'dvc exp exec-run' exits. The results are
+    collected by the 'ExperimentCollector' of the client.
+
+    Returns
+    -------
+    int
+        The peak memory usage of the experiment in bytes.
+    """
     log.info(f"Reproducing experiment '{entry_dict['name']}'")
     with dask.distributed.Lock("dvc"):
         executor = tasks.setup_exp(entry_dict=entry_dict)
         log.info(
             f"Setup Experiment '{executor.info.name}' at '{executor.info.root_dir}' "
         )
+        cache_type = dask.distributed.Variable("cache_type").get()
+        if cache_type is not None:
+            set_cache_type(os.path.join(executor.root_dir, executor.dvc_dir), cache_type)
         # we remove the experiment because collecting will not overwrite it,
         #  but add a new one
         dvc.cli.main(["exp", "remove", executor.info.name])
 
-    subprocess.check_call(["dvc", "exp", "exec-run", "--infofile", infofile])
+    if dask.distributed.Variable("in_process").get():
+        peak_rss = forkserver.check_call_dvc(
+            ["exp", "exec-run", "--infofile", infofile],
+            preload=dask.distributed.Variable("preload").get(),
+        )
+    else:
+        peak_rss = check_call_with_peak_rss(
+            ["dvc", "exp", "exec-run", "--infofile", infofile]
+        )
+    log.info(f"Experiment '{entry_dict['name']}' used {peak_rss / 1e6:.0f} MB memory")
+    return peak_rss
 
-    with dask.distributed.Lock("dvc"):
-        try:
-            log.info(f"Collect experiment '{entry_dict['name']}'")
-            tasks.collect_exp(proc_dict=None, entry_dict=entry_dict)
-        finally:
-            executor.cleanup(infofile)
 
-    return executor.info.name
+def reject_queued_experiments(
+    repo: dvc.repo.Repo, select: typing.Callable[[str], bool]
+) -> typing.List[str]:
+    """Remove the celery messages of the selected experiments from the queue.
 
+    Returns
+    -------
+    typing.List[str]
+        The names of the experiments that were removed from the queue.
+    """
+    celery_queue = repo.experiments.celery_queue
+    rejected = []
+    for msg in celery_queue.celery.iter_queued():
+        if msg.headers.get("task") != tasks.run_exp.name:
+            continue
+        args, kwargs, _embed = msg.decode()
+        entry_dict = kwargs.get("entry_dict", args[0])
+        if select(entry_dict["name"]):
+            rejected.append(entry_dict["name"])
+            celery_queue.celery.reject(msg.delivery_tag)
+    return rejected
+
+
+def _collect_experiment(repo: dvc.repo.Repo, entry: QueueEntry, infofile: str) -> None:
+    """Write the git refs of a single experiment and remove its workspace."""
+    executor_info = ExecutorInfo.load_json(infofile)
+    executor = TempDirExecutor.from_info(executor_info)
+    try:
+        if executor_info.result is not None:
+            BaseStashQueue.collect_executor(
+                repo.experiments, executor, executor_info.result
+            )
+        else:
+            repo.experiments.celery_queue.stash_failed(entry)
+    finally:
+        executor.cleanup(infofile)
+
+
+def collect_experiments(
+    dvc_root: str,
+    experiments: typing.Dict[str, typing.Tuple[QueueEntry, str]],
+    cleanup: bool,
+    repro: bool,
+) -> None:
+    """Collect finished experiments in a single batch.
+
+    The git refs of all experiments are written with a single repository instance
+    and the experiments are removed or loaded with a single DVC call each. An
+    experiment that can not be collected is logged and does not stop the others.
 
-def get_experiment_callback(name: dask.distributed.Future) -> None:
-    """Get callback to run after an experiment is done."""
-    name = name.result()
+    Parameters
+    ----------
+    dvc_root : str
+        The root directory of the DVC repository.
+    experiments : typing.Dict[str, typing.Tuple[QueueEntry, str]]
+        The QueueEntry and infofile of every experiment to collect.
+    cleanup : bool
+        Remove the experiments after they were collected.
+    repro : bool
+        Load the results of the experiments into the workspace.
+    """
+    names = list(experiments)
+    log.info(f"Collect experiments {names}")
     with dask.distributed.Lock("dvc"):
-        repo = dvc.repo.Repo()
-        queue = repo.experiments.celery_queue
-        for msg in queue.celery.iter_queued():
-            if msg.headers.get("task") != tasks.run_exp.name:
-                continue
-            args, kwargs, _embed = msg.decode()
-            entry_dict = kwargs.get("entry_dict", args[0])
-            if entry_dict["name"] == name:
-                queue.celery.reject(msg.delivery_tag)
-        if dask.distributed.Variable("cleanup").get():
+        with dvc.repo.Repo(dvc_root) as repo:
+            for name, (entry, infofile) in experiments.items():
+                try:
+                    _collect_experiment(repo, entry, infofile)
+                except Exception as err:
+                    log.critical(f"Collecting experiment '{name}' failed with {err}")
+            reject_queued_experiments(repo, lambda name: name in experiments)
+        if cleanup:
             # this one should only be called if the experiment should truly be removed
-            dvc.cli.main(["exp", "remove", name])
-        if dask.distributed.Variable("repro").get():
+            dvc.cli.main(["exp", "remove", *names])
+        if repro:
             # load experiments results into workspace
-            dvc.cli.main(["repro", "--single-item", name])
+            dvc.cli.main(["repro", "--single-item", *names])
+
+
+class ExperimentCollector:
+    """Collect finished experiments in a background thread of the client.
+
+    Workers only run 'dvc exp exec-run' and are released right after. Experiments
+    that finish while a batch is collected are collected together in the next
+    batch, see 'collect_experiments'. Failed experiments are not collected.
+
+    Use it as a context manager. Leaving the context waits until all experiments
+    that were added are collected.
+
+    Attributes
+    ----------
+    cleanup : bool
+        Remove the experiments after they were collected.
+    repro : bool
+        Load the results of the experiments into the workspace.
+    delay : float
+        Time in seconds to wait for more experiments to finish before a batch
+        is collected.
+    """
+
+    def __init__(self, cleanup: bool, repro: bool, delay: float = 0.5) -> None:
+        """Create a collector, the thread is started when entering the context."""
+        self.cleanup = cleanup
+        self.repro = repro
+        self.delay = delay
+        self._experiments = {}
+        self._finished = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self) -> "ExperimentCollector":
+        """Start collecting experiments."""
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type: typing.Any, *args: typing.Any) -> None:
+        """Wait for all experiments to be collected, unless an error occurred."""
+        self._finished.put(None)
+        if exc_type is None:
+            self._thread.join()
+
+    def add(
+        self,
+        future: dask.distributed.Future,
+        entry: QueueEntry,
+        infofile: str,
+        stage: str = None,
+    ) -> None:
+        """Collect the experiment as soon as the given future is done.
+
+        The peak memory usage of the experiment is recorded for the given stage.
+        """
+        self._experiments[future.key] = (entry, infofile, stage)
+        future.add_done_callback(self._finished.put)
+
+    def _get_batch(self) -> typing.List[typing.Optional[dask.distributed.Future]]:
+        """Wait for the next finished experiment and all that finish shortly after."""
+        batch = [self._finished.get()]
+        time.sleep(self.delay)
+        while not self._finished.empty():
+            batch.append(self._finished.get_nowait())
+        return batch
+
+    def _collect(self, futures: typing.List[dask.distributed.Future]) -> None:
+        # remove the whole batch first, so an error can not leave any behind
+        batch = [(future, *self._experiments.pop(future.key)) for future in futures]
+        experiments = {}
+        for future, entry, infofile, stage in batch:
+            if future.status != "finished":
+                continue
+            experiments[entry.name] = (entry, infofile)
+            if stage is None:
+                continue
+            try:
+                save_peak_memory(entry.dvc_root, stage, future.result())
+            except Exception as err:
+                log.critical(f"Recording memory of '{entry.name}' failed with {err}")
+        if experiments:
+            dvc_root = next(iter(experiments.values()))[0].dvc_root
+            collect_experiments(dvc_root, experiments, self.cleanup, self.repro)
+
+    def _run(self) -> None:
+        closed = False
+        while not closed or self._experiments:
+            batch = self._get_batch()
+            closed = closed or None in batch
+            try:
+                self._collect([x for x in batch if x is not None])
+            except Exception as err:
+                log.critical(f"Collecting experiments failed with {err}")
 
 
 def submit_to_dask(
-    client: dask.distributed.Client, infofile: str, entry: QueueEntry, successors: list
+    client: dask.distributed.Client,
+    collector: ExperimentCollector,
+    infofile: str,
+    entry: QueueEntry,
+    successors: list,
+    stage: str = None,
+    resources: dict = None,
 ) -> dask.distributed.Future:
-    """Submit a queued experiment to run with Dask."""
+    """Submit a queued experiment to run with Dask.
+
+    The results are collected by the given collector once the experiment finished.
+    """
     experiment = client.submit(
         reproduce_experiment,
         entry_dict=dataclasses.asdict(entry),
@@ -152,46 +490,101 @@ def submit_to_dask(
         successors=successors,
         pure=False,
         key=entry.name,
+        resources=resources,
     )
-    experiment.add_done_callback(get_experiment_callback)
+    collector.add(experiment, entry, infofile, stage=stage)
     return experiment
 
 
 def parallel_submit(
     client: dask.distributed.Client,
+    collector: ExperimentCollector,
     repo: dvc.repo.Repo,
-    stages: typing.Dict[PipelineStage, str],
-) -> typing.Tuple[typing.Dict[PipelineStage, dask.distributed.Future], typing.List[str],]:
-    """Submit experiments in parallel."""
+    graph: StageGraph,
+    stages: typing.Dict[str, str],
+    resources: typing.Dict[str, dict] = None,
+    max_tasks: int = None,
+) -> typing.Dict[str, dask.distributed.Future]:
+    """Submit experiments in parallel.
+
+    The results are collected by the given collector. The graph is the stage
+    graph of the repo, see 'get_stage_graph'.
+    The optional resources are the dask resource requests for each stage.
+    At most 'max_tasks' stages are pending on the scheduler at the same time.
+    """
+    if resources is None:
+        resources = {}
     mapping = {}
+    pending = set()
     queue_entries = get_all_queue_entries(repo)
 
     for stage in stages:
+        _, pending = wait_for_window(pending, max_tasks)
         log.debug(f"Preparing experiment '{stages[stage]}'")
-        entry, infofile = queue_entries[stages[stage]]
+        entry, infofile = queue_entries.pop(stages[stage])
         # we use get here, because some stages won't be queued, such as dependency files
-        successors = [
-            mapping.get(successor) for successor in repo.index.graph.successors(stage)
-        ]
-        mapping[stage] = submit_to_dask(client, infofile, entry, successors)
+        successors = [mapping.get(successor) for successor in graph.upstream[stage]]
+        mapping[stage] = submit_to_dask(
+            client,
+            collector,
+            infofile,
+            entry,
+            successors,
+            stage=stage,
+            resources=resources.get(stage),
+        )
+        pending.add(mapping[stage])
 
     return mapping
 
 
+def _get_status(
+    futures: typing.Iterable[dask.distributed.Future],
+) -> typing.Dict[str, str]:
+    """Get the status of finished experiments and log the failed ones."""
+    status = {}
+    for future in futures:
+        if future.status == "error":
+            log.critical(f"Experiment '{future.key}' failed with {future.exception()}")
+        status[future.key] = future.status
+    return status
+
+
 def experiment_submit(
-    client: dask.distributed.Client, repo: dvc.repo.Repo, experiments: typing.List[str]
-) -> typing.Tuple[typing.Dict[str, dask.distributed.Future], typing.List[str]]:
-    """Submit experiments in parallel."""
+    client: dask.distributed.Client,
+    collector: ExperimentCollector,
+    repo: dvc.repo.Repo,
+    experiments: typing.List[str],
+    max_tasks: int = None,
+) -> typing.Dict[str, str]:
+    """Submit experiments in parallel and wait for them to finish.
+
+    The results are collected by the given collector.
+
+    At most 'max_tasks' experiments are pending on the scheduler at the same time.
+    Finished experiments are released right away, so the number of tasks on the
+    scheduler does not grow with the size of the queue.
+
+    Returns
+    -------
+    typing.Dict[str, str]
+        The final status of every experiment, e.g. 'finished' or 'error'.
+    """
     queue_entries = get_all_queue_entries(repo)
     if experiments is None:
         experiments = list(queue_entries.keys())
-    mapping = {}
+    status = {}
+    pending = set()
     print(f"Submitting experiments: {experiments}")
 
     for experiment in experiments:
+        done, pending = wait_for_window(pending, max_tasks)
+        status.update(_get_status(done))
         log.critical(f"Preparing experiment '{experiment}'")
-        entry, infofile = queue_entries[experiment]
+        entry, infofile = queue_entries.pop(experiment)
 
-        mapping[experiment] = submit_to_dask(client, infofile, entry, None)
+        pending.add(submit_to_dask(client, collector, infofile, entry, None))
 
-    return mapping
+    dask.distributed.wait(pending)
+    status.update(_get_status(pending))
+    return status
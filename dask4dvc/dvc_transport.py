@@ -0,0 +1,372 @@
+"""Run DVC stages on workers that do not share a filesystem with the client.
+
+Instead of queuing experiments in the repository, the files that a stage needs are
+sent to the worker as content addressed, compressed objects. The worker runs the
+stage in a local scratch directory and sends back its outputs. They are written into
+the workspace of the client and committed, like 'dvc commit', so the stages never
+run on the client. This also works for stages that the run cache can not store,
+e.g. stages without deps or with 'cache: false' outputs.
+"""
+import collections
+import hashlib
+import logging
+import os
+import pathlib
+import subprocess
+import tempfile
+import typing
+import uuid
+import zlib
+
+import dask.distributed
+import dvc.repo
+from dvc.stage import Stage
+
+from dask4dvc import dvc_repro
+from dask4dvc.utils import forkserver
+from dask4dvc.utils.graph import StageGraph
+from dask4dvc.utils.memory import check_call_with_peak_rss, save_peak_memory
+
+log = logging.getLogger(__name__)
+
+# map file path to content hash
+Files = typing.Dict[str, str]
+# map content hash to compressed content
+Objects = typing.Dict[str, bytes]
+
+CHUNK_SIZE = 2**24
+
+
+def _walk(path: pathlib.Path) -> typing.Iterator[pathlib.Path]:
+    """Iterate all files in the given file or directory."""
+    if path.is_dir():
+        yield from sorted(x for x in path.rglob("*") if x.is_file())
+    elif path.is_file():
+        yield path
+
+
+def _read_chunks(path: pathlib.Path) -> typing.Iterator[bytes]:
+    with path.open("rb") as file:
+        yield from iter(lambda: file.read(CHUNK_SIZE), b"")
+
+
+def _compress(path: pathlib.Path) -> bytes:
+    compressor = zlib.compressobj()
+    data = [compressor.compress(chunk) for chunk in _read_chunks(path)]
+    data.append(compressor.flush())
+    return b"".join(data)
+
+
+def _decompress(path: pathlib.Path, data: bytes) -> None:
+    decompressor, data = zlib.decompressobj(), memoryview(data)
+    with path.open("wb") as file:
+        for start in range(0, len(data), CHUNK_SIZE):
+            file.write(decompressor.decompress(data[start : start + CHUNK_SIZE]))
+        file.write(decompressor.flush())
+
+
+def pack_files(
+    root: pathlib.Path,
+    paths: typing.Iterable[str],
+    known: typing.Container[str] = (),
+) -> typing.Tuple[Files, Objects]:
+    """Pack files into content addressed, compressed objects.
+
+    The files are hashed and compressed in chunks of 'CHUNK_SIZE' bytes, so only
+    the compressed content is held in memory.
+
+    Parameters
+    ----------
+    root : pathlib.Path
+        The directory the paths are relative to.
+    paths : typing.Iterable[str]
+        Files or directories to pack. Missing paths are ignored.
+    known : typing.Container[str], optional
+        Content hashes that are already available and do not need to be packed.
+
+    Returns
+    -------
+    Files, Objects
+        The relative path of every file mapped to its content hash and the
+        compressed content for every hash that is not known, yet.
+    """
+    files, objects = {}, {}
+    for path in paths:
+        for file in _walk(root / path):
+            digest = hashlib.sha256()
+            for chunk in _read_chunks(file):
+                digest.update(chunk)
+            key = digest.hexdigest()
+            files[file.relative_to(root).as_posix()] = key
+            if key not in known and key not in objects:
+                objects[key] = _compress(file)
+    return files, objects
+
+
+def unpack_files(root: pathlib.Path, files: Files, objects: Objects) -> None:
+    """Write packed files into the given directory."""
+    for name, key in files.items():
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        _decompress(path, objects[key])
+
+
+def _scattered_key(key: str) -> str:
+    # dask would otherwise replace the content hashes in the 'files' arguments
+    #  with the scattered data
+    return f"dask4dvc-{key}"
+
+
+def gather_objects(
+    client: dask.distributed.Client, files: Files, objects: Objects
+) -> Objects:
+    """Add the objects of the given files that were scattered but not sent along.
+
+    Outputs only contain the objects that were not scattered to the cluster
+    before, see 'scatter_objects'. The remaining ones are gathered by their key.
+    """
+    missing = sorted({key for key in files.values() if key not in objects})
+    if not missing:
+        return objects
+    futures = [dask.distributed.Future(_scattered_key(key), client) for key in missing]
+    return {**objects, **dict(zip(missing, client.gather(futures)))}
+
+
+def reproduce_stage(
+    addressing: str,
+    outs: typing.List[str],
+    files: Files,
+    objects: Objects,
+    predecessors: typing.List[dict],
+    preload: typing.List[str] = None,
+) -> dict:
+    """Reproduce a single stage in a local scratch directory.
+
+    Parameters
+    ----------
+    addressing : str
+        The DVC address of the stage, e.g. 'dvc.yaml:stage'.
+    outs : typing.List[str]
+        The outputs of the stage, relative to the repository root.
+    files, objects : Files, Objects
+        The packed source code, pipeline files, params and deps of the stage.
+    predecessors : typing.List[dict]
+        Results of the upstream stages that provide the remaining deps.
+    preload : typing.List[str], optional
+        If given, run the stage in a process forked from a forkserver that
+        imported these modules, see 'dask4dvc.utils.forkserver'.
+
+    Returns
+    -------
+    dict
+        The packed 'outs' of the stage as 'files' and 'objects' and the peak memory
+        usage of the stage as 'peak_rss'. Objects that were scattered to the
+        cluster are not sent back, see 'gather_objects'.
+    """
+    files, objects = dict(files), dict(objects)
+    scattered = set(objects)
+    for result in predecessors:
+        files.update(result["files"])
+        objects.update(result["objects"])
+    objects = gather_objects(dask.distributed.get_client(), files, objects)
+
+    with tempfile.TemporaryDirectory(prefix="dask4dvc-") as scratch:
+        scratch = pathlib.Path(scratch)
+        log.info(f"Reproducing stage '{addressing}' in '{scratch}'")
+        unpack_files(scratch, files, objects)
+        if preload is None:
+            subprocess.check_call(["dvc", "init", "--no-scm", "--quiet"], cwd=scratch)
+            peak_rss = check_call_with_peak_rss(
+                ["dvc", "repro", "--single-item", addressing], cwd=scratch
+            )
+        else:
+            peak_rss = forkserver.check_call_dvc(
+                ["repro", "--single-item", addressing],
+                cwd=scratch,
+                preload=preload,
+                init=True,
+            )
+
+        out_files, out_objects = pack_files(scratch, outs, known=scattered)
+
+    return {"files": out_files, "objects": out_objects, "peak_rss": peak_rss}
+
+
+def store_outputs(
+    repo: dvc.repo.Repo, stage: Stage, result: dict, client: dask.distributed.Client
+) -> None:
+    """Write the outputs of a reproduced stage into the workspace and commit them.
+
+    The outputs are added to the cache and the run cache and 'dvc.lock' is
+    updated, the same way 'dvc repro' does it after running the command.
+    """
+    objects = gather_objects(client, result["files"], result["objects"])
+    with repo.lock:
+        stage.remove_outs(ignore_remove=False, force=False)
+        unpack_files(pathlib.Path(repo.root_dir), result["files"], objects)
+        stage.save()
+        stage.commit()
+        stage.dump(update_pipeline=False)
+
+
+def collect_outputs(
+    repo: dvc.repo.Repo,
+    stages: typing.Dict[str, Stage],
+    futures: typing.Iterable[dask.distributed.Future],
+) -> typing.Dict[str, str]:
+    """Store the results of finished stages in the workspace.
+
+    Also records the peak memory usage of every stage. Failed stages are skipped.
+
+    Parameters
+    ----------
+    repo : dvc.repo.Repo
+        The DVC repo to store the outputs in.
+    stages : typing.Dict[str, Stage]
+        The key of every future mapped to its stage.
+    futures : typing.Iterable[dask.distributed.Future]
+        Finished futures of 'reproduce_stage'.
+
+    Returns
+    -------
+    typing.Dict[str, str]
+        The addressing of every stage mapped to the status of its future.
+    """
+    status = {}
+    for future in futures:
+        stage = stages.pop(future.key)
+        status[stage.addressing] = future.status
+        if future.status == "finished":
+            result = future.result()
+            store_outputs(repo, stage, result, future.client)
+            save_peak_memory(repo.root_dir, stage.addressing, result["peak_rss"])
+        else:
+            log.critical(f"Stage '{stage.addressing}' failed: {future.exception()}")
+    return status
+
+
+def get_tracked_files(repo: dvc.repo.Repo) -> typing.List[str]:
+    """Get all files that are tracked by git, e.g. source code and pipeline files."""
+    output = subprocess.check_output(["git", "ls-files", "-z"], cwd=repo.root_dir)
+    return [
+        name
+        for name in output.decode().split("\0")
+        if name and not name.startswith(".dvc/")
+    ]
+
+
+def scatter_objects(
+    client: dask.distributed.Client, objects: Objects
+) -> typing.Dict[str, dask.distributed.Future]:
+    """Scatter packed objects to the cluster."""
+    if not objects:
+        return {}
+    futures = client.scatter({_scattered_key(key): data for key, data in objects.items()})
+    return {key: futures[_scattered_key(key)] for key in objects}
+
+
+def _relpath(repo: dvc.repo.Repo, path: str) -> str:
+    return pathlib.Path(os.path.relpath(path, repo.root_dir)).as_posix()
+
+
+def _get_deps(repo: dvc.repo.Repo, stage: Stage, upstream_outs: list) -> list:
+    """Get the local deps of the stage that are not provided by upstream stages."""
+    deps = [_relpath(repo, dep.fs_path) for dep in stage.deps if dep.protocol == "local"]
+    return [
+        dep
+        for dep in deps
+        if not any(dep == out or dep.startswith(f"{out}/") for out in upstream_outs)
+    ]
+
+
+def transport_submit(
+    client: dask.distributed.Client,
+    repo: dvc.repo.Repo,
+    graph: StageGraph,
+    targets: typing.List[str],
+    resources: typing.Dict[str, dict] = None,
+    preload: typing.List[str] = None,
+    max_tasks: int = None,
+) -> typing.Dict[str, str]:
+    """Reproduce stages on workers without a shared filesystem.
+
+    The graph is the stage graph of the repo, see 'get_stage_graph'.
+    Stages that did not change or can be restored from the run cache are skipped,
+    unless an upstream stage has to run.
+    Every object is scattered to the cluster only once, even if it is used by
+    multiple stages. Outputs of upstream stages are passed between the workers
+    by dask directly. The outputs are stored in the workspace as soon as a stage
+    finished, while further stages are submitted, see 'collect_outputs'.
+    The optional resources are the dask resource requests for each stage.
+    If preload is given, the stages run in processes forked from a forkserver that
+    imported these modules. At most 'max_tasks' stages are pending on the
+    scheduler at the same time.
+
+    Returns
+    -------
+    typing.Dict[str, str]
+        The addressing of every submitted stage mapped to its final status,
+        e.g. 'finished' or 'error'.
+    """
+    if resources is None:
+        resources = {}
+    root = pathlib.Path(repo.root_dir)
+    tracked_files, tracked_objects = pack_files(root, get_tracked_files(repo))
+    scattered = scatter_objects(client, tracked_objects)
+    del tracked_objects
+
+    ordered_stages = dvc_repro.get_ordered_stages(repo, graph, targets)
+    stages = dvc_repro.load_stages(repo, ordered_stages)
+    # number of stages that still need the result of an upstream stage
+    downstream = collections.Counter(
+        x for addressing in ordered_stages for x in graph.upstream[addressing]
+    )
+
+    mapping, submitted, status = {}, {}, {}
+    completed = dask.distributed.as_completed()
+    for addressing in ordered_stages:
+        status.update(collect_outputs(repo, submitted, completed.next_batch(block=False)))
+        while max_tasks is not None and completed.count() >= max_tasks:
+            status.update(collect_outputs(repo, submitted, completed.next_batch()))
+
+        stage = stages[addressing]
+        upstream = [x for x in graph.upstream[addressing] if x in mapping]
+        downstream.subtract(graph.upstream[addressing])
+        if not upstream and dvc_repro.restore_stage(repo, stage):
+            log.info(f"Stage '{addressing}' is cached, skipping")
+            continue
+
+        upstream_outs = [
+            _relpath(repo, out.fs_path) for x in upstream for out in stages[x].outs
+        ]
+        files, objects = pack_files(
+            root, _get_deps(repo, stage, upstream_outs), known=scattered
+        )
+        scattered.update(scatter_objects(client, objects))
+
+        files = {**tracked_files, **files}
+        log.debug(f"Submitting stage '{addressing}'")
+        future = client.submit(
+            reproduce_stage,
+            addressing=addressing,
+            outs=[_relpath(repo, out.fs_path) for out in stage.outs],
+            files=files,
+            objects={key: scattered[key] for key in set(files.values())},
+            predecessors=[mapping[x] for x in upstream],
+            preload=preload,
+            pure=False,
+            key=f"{addressing}-dask4dvc-{str(uuid.uuid4())[:8]}",
+            resources=resources.get(addressing),
+        )
+        submitted[future.key] = stage
+        completed.add(future)
+        # only keep the results that stages which are not yet submitted depend on
+        if downstream[addressing] > 0:
+            mapping[addressing] = future
+        for x in upstream:
+            if downstream[x] <= 0:
+                del mapping[x]
+
+    for batch in completed.batches():
+        status.update(collect_outputs(repo, submitted, batch))
+    return status
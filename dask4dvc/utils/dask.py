@@ -41,3 +41,67 @@ def get_cluster_from_config(file: str) -> dask_jobqueue.core.JobQueueCluster:
     cluster = getattr(dask_jobqueue, cluster_name)(**default[cluster_name])
     cluster.adapt()
     return cluster
+
+
+def get_memory_resources(
+    client: Client, peak_memory: typing.Dict[str, int], timeout: float = 60
+) -> typing.Dict[str, typing.Dict[str, int]]:
+    """Convert the recorded peak memory of stages into dask resource requests.
+
+    The workers must provide a 'memory' resource, e.g. via
+    'dask-worker --resources memory=16e9'. Requests are limited to the largest
+    worker, so that every stage can still be scheduled. Waits up to 'timeout'
+    seconds for the first worker, e.g. of an adaptive cluster. Without a worker
+    the requests can not be limited and are skipped.
+    """
+    if not peak_memory:
+        return {}
+    try:
+        client.wait_for_workers(1, timeout=timeout)
+    except TimeoutError:
+        log.warning("No worker connected. Ignoring memory usage.")
+        return {}
+    available = [
+        worker["resources"].get("memory", 0)
+        for worker in client.scheduler_info()["workers"].values()
+    ]
+    if not any(available):
+        log.warning("No worker provides a 'memory' resource. Ignoring memory usage.")
+        return {}
+    limit = max(available)
+    return {stage: {"memory": min(peak, limit)} for stage, peak in peak_memory.items()}
+
+
+def wait_for_window(
+    futures: typing.Set[Future], max_tasks: typing.Optional[int]
+) -> typing.Tuple[typing.Set[Future], typing.Set[Future]]:
+    """Wait until less than 'max_tasks' of the given futures are pending.
+
+    Parameters
+    ----------
+    futures : typing.Set[Future]
+        The futures that were submitted.
+    max_tasks : int, optional
+        The maximum number of pending futures. If 'None', this does not wait and
+        all futures are returned as pending.
+
+    Returns
+    -------
+    typing.Set[Future], typing.Set[Future]
+        The done and the still pending futures.
+
+    Raises
+    ------
+    ValueError
+        If 'max_tasks' is smaller than 1, which would wait forever.
+    """
+    if max_tasks is not None and max_tasks < 1:
+        raise ValueError(f"'max_tasks' must be at least 1, got {max_tasks}")
+    if max_tasks is None:
+        return set(), futures
+    pending = {x for x in futures if not x.done()}
+    done = futures - pending
+    while len(pending) >= max_tasks:
+        finished, pending = wait(pending, return_when="FIRST_COMPLETED")
+        done |= finished
+    return done, pending
@@ -0,0 +1,181 @@
+"""Run DVC commands in processes forked from a warm forkserver.
+
+Running 'dvc' and 'zntrack run' as subprocesses starts a new Python interpreter for
+every stage which imports DVC, ZnTrack and the packages used by the Node before any
+work is done. Instead, the commands can run in processes that are forked from a
+forkserver that has imported these modules already. 'zntrack run' commands of a
+stage are executed inside of this process as well.
+
+Every command still runs in its own process, so locks and outputs behave the same
+as with the 'dvc' subprocess.
+"""
+import contextlib
+import multiprocessing
+import os
+import shlex
+import subprocess
+import sys
+import typing
+
+from dask4dvc.utils.memory import wait_with_peak_rss
+
+PRELOAD = [
+    "dvc.cli",
+    "dvc.repo",
+    "dvc.repo.experiments.executor.local",
+    "dvc.stage.run",
+    "zntrack",
+    "zntrack.cli",
+]
+
+
+def get_context(
+    preload: typing.List[str] = None,
+) -> multiprocessing.context.ForkServerContext:
+    """Get the forkserver context.
+
+    The forkserver is started on first use, so only the modules given to the first
+    call are imported. Modules that can not be imported are skipped. Only add
+    packages that are not part of the repository, e.g. 'numpy' or 'torch'.
+    Otherwise, the stages would use the preloaded code instead of their own.
+    """
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(PRELOAD + list(preload or []))
+    return context
+
+
+@contextlib.contextmanager
+def _environ(cwd: str, env: dict) -> typing.Iterator[None]:
+    """Temporarily change the working directory and environment variables."""
+    old_cwd, old_env = os.getcwd(), dict(os.environ)
+    os.chdir(cwd)
+    os.environ.clear()
+    os.environ.update(env)
+    try:
+        yield
+    finally:
+        os.chdir(old_cwd)
+        os.environ.clear()
+        os.environ.update(old_env)
+
+
+def _get_exit_code(err: SystemExit) -> int:
+    """Get the exit code a process would have after the given 'SystemExit'."""
+    if err.code is None:
+        return 0
+    if isinstance(err.code, int):
+        return err.code
+    return 1
+
+
+def _split_command(cmd: str) -> typing.Optional[typing.List[str]]:
+    """Split a command into its arguments, unless only a shell can run it.
+
+    Returns 'None' for commands with shell operators, e.g. '>', '&&', '|' or ';',
+    and for variable or command substitutions.
+    """
+    lexer = shlex.shlex(cmd, posix=True, punctuation_chars=True)
+    lexer.whitespace_split = True
+    argv = list(lexer)
+    operators = set(lexer.punctuation_chars)
+    if any(token and set(token) <= operators for token in argv):
+        return None
+    if any(char in cmd for char in "$`"):
+        return None
+    return argv
+
+
+def _patch_zntrack_run() -> None:
+    """Execute 'zntrack run' commands of stages in the current process.
+
+    Exit codes and 'SystemExit' are handled the same way as for a 'zntrack'
+    subprocess, a non-zero exit code raises 'StageCmdFailedError'. Commands that
+    need a shell, e.g. 'zntrack run ... && echo done', run with DVC's runner.
+    """
+    import dvc.stage.run
+    import zntrack.cli
+    from dvc.stage.exceptions import StageCmdFailedError
+
+    run = dvc.stage.run._run
+
+    def _run(
+        stage: typing.Any,
+        executable: typing.Optional[str],
+        cmd: str,
+        checkpoint_func: typing.Optional[typing.Callable],
+        **kwargs: typing.Any,
+    ) -> None:
+        argv = _split_command(cmd)
+        if argv is None or argv[:2] != ["zntrack", "run"] or checkpoint_func:
+            return run(stage, executable, cmd, checkpoint_func, **kwargs)
+        with _environ(kwargs["cwd"], kwargs["env"]):
+            try:
+                returncode = zntrack.cli.app(
+                    args=argv[1:], prog_name="zntrack", standalone_mode=False
+                )
+            except SystemExit as err:
+                returncode = _get_exit_code(err)
+            except Exception as err:
+                raise StageCmdFailedError(cmd, 1) from err
+        if returncode:
+            raise StageCmdFailedError(cmd, returncode)
+
+    dvc.stage.run._run = _run
+
+
+def _main(args: typing.List[str], cwd: typing.Optional[str], init: bool) -> None:
+    """Run 'dvc <args>' in the current process."""
+    import dvc.cli
+    import dvc.repo
+
+    with contextlib.suppress(ImportError):
+        _patch_zntrack_run()
+    if cwd is not None:
+        os.chdir(cwd)
+    if init:
+        dvc.repo.Repo.init(no_scm=True).close()
+    sys.exit(dvc.cli.main(args))
+
+
+def check_call_dvc(
+    args: typing.List[str],
+    cwd: str = None,
+    preload: typing.List[str] = None,
+    init: bool = False,
+) -> int:
+    """Run 'dvc <args>' like 'subprocess.check_call' in a forked process.
+
+    Parameters
+    ----------
+    args : typing.List[str]
+        The arguments passed to 'dvc'.
+    cwd : str, optional
+        The working directory of the command.
+    preload : typing.List[str], optional
+        Additional modules to import in the forkserver, see 'get_context'.
+    init : bool, optional
+        Initialize a DVC repository without git in 'cwd' before running the
+        command, like 'dvc init --no-scm'.
+
+    Returns
+    -------
+    int
+        The peak resident set size in bytes of the forked process and its children.
+
+    Raises
+    ------
+    subprocess.CalledProcessError
+        If the command exits with a non-zero exit code.
+    """
+    if multiprocessing.current_process().daemon:
+        raise RuntimeError(
+            "Daemonic dask workers can not start processes. Set"
+            " 'distributed.worker.daemon: False' in the dask config of the workers."
+        )
+    proc = get_context(preload).Process(target=_main, args=(args, cwd, init))
+    proc.start()
+    peak_rss = wait_with_peak_rss(proc.pid, proc.is_alive)
+    proc.join()
+    if proc.exitcode != 0:
+        raise subprocess.CalledProcessError(proc.exitcode, ["dvc", *args])
+    return peak_rss
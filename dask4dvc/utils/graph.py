@@ -0,0 +1,197 @@
+"""Cache the DVC stage graph on disk.
+
+Collecting 'repo.index.graph' parses every pipeline file of the repository, which
+can take a long time for large repositories. The addressing of every stage and
+its upstream stages are stored in '.dvc/tmp/dask4dvc/graph.json' together with a
+fingerprint of all pipeline and params files and the files read by 'vars'. The
+cache is rebuilt whenever one of these files, DVC or dask4dvc changes.
+"""
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import posixpath
+import subprocess
+import tempfile
+import typing
+
+import dvc
+import dvc.repo
+import networkx as nx
+import yaml
+from dvc.dependency import ParamsDependency
+from dvc.stage import PipelineStage
+
+import dask4dvc
+
+log = logging.getLogger(__name__)
+
+# 'dvc.lock' files are not included, they don't change the structure of the graph
+PIPELINE_FILES = ["*dvc.yaml", "*.dvc", "*params.yaml", "*.dvcignore"]
+
+
+@dataclasses.dataclass
+class StageGraph:
+    """The stages of a DVC repository.
+
+    Attributes
+    ----------
+    upstream : typing.Dict[str, typing.List[str]]
+        The addressing of every stage, mapped to the stages it depends on.
+    pipeline_stages : typing.List[str]
+        The stages defined in 'dvc.yaml' files, in contrast to '.dvc' files.
+    params : typing.List[str]
+        Params files used by the stages, relative to the repository root.
+    vars : typing.List[str]
+        Files read by the 'vars' of 'dvc.yaml' files, see 'get_vars_files'.
+    """
+
+    upstream: typing.Dict[str, typing.List[str]]
+    pipeline_stages: typing.List[str]
+    params: typing.List[str]
+    vars: typing.List[str]
+
+    def get_steps(self, targets: typing.List[str]) -> typing.List[str]:
+        """Get the targets and all their upstream stages, dependencies first."""
+        graph = nx.DiGraph()
+        graph.add_nodes_from(self.upstream)
+        graph.add_edges_from(
+            (stage, upstream)
+            for stage, upstreams in self.upstream.items()
+            for upstream in upstreams
+        )
+        steps = {}
+        for target in targets:
+            steps.update(dict.fromkeys(nx.dfs_postorder_nodes(graph, target)))
+        return list(steps)
+
+
+def collect_stage_graph(
+    repo: dvc.repo.Repo, pipeline_files: typing.Iterable[str]
+) -> StageGraph:
+    """Collect the stage graph from the DVC index."""
+    graph = repo.index.graph
+    root = pathlib.Path(repo.root_dir)
+    params = set()
+    for stage in graph:
+        for dep in stage.deps:
+            if isinstance(dep, ParamsDependency):
+                params.add(pathlib.Path(dep.fs_path).relative_to(root).as_posix())
+    return StageGraph(
+        upstream={
+            # frozen stages are disconnected from their deps, same as in DVC
+            stage.addressing: (
+                [] if stage.frozen else [x.addressing for x in graph.successors(stage)]
+            )
+            for stage in graph
+        },
+        pipeline_stages=[x.addressing for x in graph if isinstance(x, PipelineStage)],
+        params=sorted(params),
+        vars=sorted(get_vars_files(root, pipeline_files)),
+    )
+
+
+def get_vars_files(
+    root: pathlib.Path, pipeline_files: typing.Iterable[str]
+) -> typing.Set[str]:
+    """Get the files that the 'vars' of 'dvc.yaml' files read.
+
+    This includes the top-level 'vars' and the 'vars' of every stage, relative to
+    the 'wdir' of the stage. Keys to import, e.g. 'config.json:key', are removed.
+
+    Returns
+    -------
+    typing.Set[str]
+        The files relative to the repository root.
+    """
+    files = set()
+    for name in pipeline_files:
+        if not name.endswith("dvc.yaml"):
+            continue
+        try:
+            data = yaml.safe_load((root / name).read_text()) or {}
+        except (OSError, yaml.YAMLError):
+            continue
+        scopes = [("", data.get("vars", []))] + [
+            (stage.get("wdir", ""), stage.get("vars", []))
+            for stage in data.get("stages", {}).values()
+            if isinstance(stage, dict)
+        ]
+        for wdir, entries in scopes:
+            for entry in entries:
+                if isinstance(entry, str):
+                    path = posixpath.join(posixpath.dirname(name), wdir, entry)
+                    files.add(posixpath.normpath(path.split(":", 1)[0]))
+    return files
+
+
+def get_pipeline_files(repo: dvc.repo.Repo) -> typing.List[str]:
+    """Get all pipeline files of the repository.
+
+    They are found with 'git ls-files', so ignored files like DVC outputs are
+    not searched.
+    """
+    output = subprocess.check_output(
+        ["git", "ls-files", "-z", "--cached", "--others", "--exclude-standard", "--"]
+        + PIPELINE_FILES,
+        cwd=repo.root_dir,
+    )
+    return [name for name in output.decode().split("\0") if name]
+
+
+def get_fingerprint(repo: dvc.repo.Repo, files: typing.Iterable[str]) -> str:
+    """Hash the content of the given files and the versions of DVC and dask4dvc."""
+    fingerprint = hashlib.sha256(dvc.__version__.encode())
+    fingerprint.update(dask4dvc.__version__.encode())
+    for name in sorted(set(files)):
+        path = pathlib.Path(repo.root_dir, name)
+        if path.is_file():
+            fingerprint.update(name.encode())
+            fingerprint.update(hashlib.sha256(path.read_bytes()).digest())
+    return fingerprint.hexdigest()
+
+
+def _get_graph_file(repo: dvc.repo.Repo) -> pathlib.Path:
+    return pathlib.Path(repo.tmp_dir, "dask4dvc", "graph.json")
+
+
+def _load_stage_graph(file: pathlib.Path) -> typing.Tuple[StageGraph, str]:
+    """Load the cached stage graph and its fingerprint."""
+    data = json.loads(file.read_text())
+    return StageGraph(**data["graph"]), data["fingerprint"]
+
+
+def get_stage_graph(repo: dvc.repo.Repo) -> StageGraph:
+    """Load the stage graph from the cache or collect and cache it.
+
+    A cache file that can not be read, e.g. written by another version of
+    dask4dvc, is ignored and replaced.
+    """
+    pipeline_files = get_pipeline_files(repo)
+    file = _get_graph_file(repo)
+    if file.exists():
+        try:
+            graph, fingerprint = _load_stage_graph(file)
+        except (json.JSONDecodeError, TypeError, KeyError) as err:
+            log.debug(f"Ignoring the cached stage graph in '{file}': {err}")
+        else:
+            if fingerprint == get_fingerprint(
+                repo, pipeline_files + graph.params + graph.vars
+            ):
+                log.debug(f"Using cached stage graph from '{file}'")
+                return graph
+
+    graph = collect_stage_graph(repo, pipeline_files)
+    data = {
+        "fingerprint": get_fingerprint(repo, pipeline_files + graph.params + graph.vars),
+        "graph": dataclasses.asdict(graph),
+    }
+    file.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        "w", dir=file.parent, prefix=f"{file.name}.", delete=False
+    ) as tmp:
+        json.dump(data, tmp)
+    os.replace(tmp.name, file)
+    return graph
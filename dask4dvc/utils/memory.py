@@ -0,0 +1,126 @@
+"""Utils to measure and record the memory usage of stages."""
+import json
+import logging
+import os
+import pathlib
+import subprocess
+import tempfile
+import time
+import typing
+
+import psutil
+
+log = logging.getLogger(__name__)
+
+
+def _get_rss(proc: psutil.Process) -> int:
+    """Get the resident set size of a process and all its children."""
+    rss = 0
+    try:
+        processes = [proc, *proc.children(recursive=True)]
+    except psutil.NoSuchProcess:
+        return rss
+    for process in processes:
+        try:
+            rss += process.memory_info().rss
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            pass
+    return rss
+
+
+def wait_with_peak_rss(
+    pid: int, is_running: typing.Callable[[], bool], interval: float = 0.1
+) -> int:
+    """Wait for a process to finish and measure the memory usage of its process tree.
+
+    Parameters
+    ----------
+    pid : int
+        The id of the process to measure.
+    is_running : typing.Callable[[], bool]
+        Returns whether the process is still running.
+    interval : float, optional
+        Time in seconds between two samples of the memory usage.
+
+    Returns
+    -------
+    int
+        The peak resident set size in bytes of the process tree.
+    """
+    peak_rss = 0
+    try:
+        proc = psutil.Process(pid)
+    except psutil.NoSuchProcess:
+        proc = None
+    while is_running():
+        if proc is not None:
+            peak_rss = max(peak_rss, _get_rss(proc))
+        time.sleep(interval)
+    return peak_rss
+
+
+def check_call_with_peak_rss(
+    cmd: typing.List[str], interval: float = 0.1, **kwargs: typing.Any
+) -> int:
+    """Run a command like 'subprocess.check_call' and measure its memory usage.
+
+    Parameters
+    ----------
+    cmd : typing.List[str]
+        The command to run.
+    interval : float, optional
+        Time in seconds between two samples of the memory usage.
+    kwargs : dict
+        Additional arguments passed to 'subprocess.Popen'.
+
+    Returns
+    -------
+    int
+        The peak resident set size in bytes of the process tree started by 'cmd'.
+
+    Raises
+    ------
+    subprocess.CalledProcessError
+        If the command exits with a non-zero return code.
+    """
+    proc = subprocess.Popen(cmd, **kwargs)
+    peak_rss = wait_with_peak_rss(proc.pid, lambda: proc.poll() is None, interval)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return peak_rss
+
+
+def _get_memory_file(dvc_root: str) -> pathlib.Path:
+    return pathlib.Path(dvc_root, ".dvc", "tmp", "dask4dvc", "memory.json")
+
+
+def load_peak_memory(dvc_root: str) -> typing.Dict[str, int]:
+    """Load the recorded peak memory usage of every stage in bytes.
+
+    A file that can not be read is treated as if nothing was recorded, yet.
+    """
+    file = _get_memory_file(dvc_root)
+    if not file.exists():
+        return {}
+    try:
+        return json.loads(file.read_text())
+    except json.JSONDecodeError as err:
+        log.warning(f"Ignoring the recorded memory usage in '{file}': {err}")
+        return {}
+
+
+def save_peak_memory(dvc_root: str, stage: str, peak_rss: int) -> None:
+    """Record the peak memory usage of a stage, replacing earlier measurements.
+
+    The file is replaced atomically, so it is never left half written. Concurrent
+    calls can still lose measurements, so it should be called with a lock.
+    """
+    file = _get_memory_file(dvc_root)
+    data = load_peak_memory(dvc_root)
+    data[stage] = peak_rss
+    file.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        "w", dir=file.parent, prefix=f"{file.name}.", delete=False
+    ) as tmp:
+        json.dump(data, tmp, indent=4)
+    os.replace(tmp.name, file)
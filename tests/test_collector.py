@@ -0,0 +1,64 @@
+"""Test collecting finished experiments on the client."""
+import threading
+import types
+import typing
+
+import dask.distributed
+import pytest
+
+from dask4dvc import dvc_repro
+
+
+def run_experiment(name: str) -> int:
+    """Pretend to run an experiment and return its peak memory."""
+    return 42
+
+
+def collect(
+    client: dask.distributed.Client, names: typing.List[str], stage: str = None
+) -> typing.List[typing.Dict[str, str]]:
+    """Run experiments and return the status of the futures in every batch."""
+    futures, batches = {}, []
+
+    def collect_experiments(
+        dvc_root: str, experiments: dict, cleanup: bool, repro: bool
+    ) -> None:
+        batches.append({name: futures[name].status for name in experiments})
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(dvc_repro, "collect_experiments", collect_experiments)
+        with dvc_repro.ExperimentCollector(True, False, delay=2) as collector:
+            for name in names:
+                futures[name] = client.submit(run_experiment, name, key=name)
+                entry = types.SimpleNamespace(name=name, dvc_root=".")
+                collector.add(futures[name], entry, f"{name}.run", stage=stage)
+    return batches
+
+
+def test_experiment_collector() -> None:
+    """Test that experiments finished shortly after each other are batched."""
+    with dask.distributed.Client(processes=False, n_workers=1) as client:
+        batches = collect(client, ["a", "b", "c"])
+
+    # the workers were released before the experiments were collected
+    assert batches == [{"a": "finished", "b": "finished", "c": "finished"}]
+
+
+def test_experiment_collector_error(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that an error while recording the memory does not block the collector."""
+
+    def save_peak_memory(dvc_root: str, stage: str, peak_rss: int) -> None:
+        raise ValueError("corrupted file")
+
+    monkeypatch.setattr(dvc_repro, "save_peak_memory", save_peak_memory)
+    batches = []
+    with dask.distributed.Client(processes=False, n_workers=1) as client:
+        thread = threading.Thread(
+            target=lambda: batches.extend(collect(client, ["a", "b"], stage="stage")),
+            daemon=True,
+        )
+        thread.start()
+        thread.join(timeout=60)
+        assert not thread.is_alive()
+
+    assert batches == [{"a": "finished", "b": "finished"}]
@@ -0,0 +1,85 @@
+"""Test running DVC commands in processes forked from a forkserver."""
+import os
+import pathlib
+import sys
+
+import dvc.repo
+import dvc.stage.run
+import pytest
+import typer
+import zntrack
+from dvc.stage.exceptions import StageCmdFailedError
+
+from dask4dvc.utils import forkserver
+
+
+class ExitNode(zntrack.Node):
+    """Exit with the given code."""
+
+    code: int = zntrack.zn.params()
+    use_typer: bool = zntrack.zn.params()
+    output = zntrack.zn.outs()
+
+    def run(self) -> None:
+        """ZnTrack run method."""
+        pathlib.Path("ran.txt").write_text(str(self.code))
+        if self.use_typer:
+            raise typer.Exit(self.code)
+        sys.exit(self.code)
+
+
+@pytest.mark.parametrize(
+    ("code", "use_typer"), [(3, False), (3, True), (0, False), (None, False)]
+)
+def test_zntrack_run_exit_code(
+    repo_path: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+    code: int,
+    use_typer: bool,
+) -> None:
+    """Test that exit codes of 'zntrack run' are handled like for a subprocess."""
+    with zntrack.Project() as project:
+        node = ExitNode(code=code, use_typer=use_typer)
+    project.run(repro=False)
+
+    monkeypatch.setattr(dvc.stage.run, "_run", dvc.stage.run._run)
+    forkserver._patch_zntrack_run()
+    stage = dvc.repo.Repo().stage.get_target(node.name)
+    kwargs = {"cwd": os.getcwd(), "env": dict(os.environ)}
+
+    if code:
+        with pytest.raises(StageCmdFailedError):
+            dvc.stage.run._run(stage, None, stage.cmd, None, **kwargs)
+    else:
+        # raises 'StageCmdFailedError' if the command failed
+        dvc.stage.run._run(stage, None, stage.cmd, None, **kwargs)
+    assert pathlib.Path("ran.txt").read_text() == str(code)
+
+
+def test_zntrack_run_shell_operators(
+    repo_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test that commands which need a shell are run by DVC."""
+    with zntrack.Project() as project:
+        node = ExitNode(code=0, use_typer=False)
+    project.run(repro=False)
+
+    monkeypatch.setattr(dvc.stage.run, "_run", dvc.stage.run._run)
+    forkserver._patch_zntrack_run()
+    stage = dvc.repo.Repo().stage.get_target(node.name)
+    kwargs = {"cwd": os.getcwd(), "env": dict(os.environ), "shell": True}
+
+    cmd = f"{stage.cmd} && echo done > done.txt"
+    dvc.stage.run._run(stage, None, cmd, None, **kwargs)
+    assert pathlib.Path("ran.txt").read_text() == "0"
+    assert pathlib.Path("done.txt").read_text() == "done\n"
+
+    assert forkserver._split_command("zntrack run a.B --name 'x > y'") == [
+        "zntrack",
+        "run",
+        "a.B",
+        "--name",
+        "x > y",
+    ]
+    assert forkserver._split_command("zntrack run a.B>log.txt") is None
+    assert forkserver._split_command("zntrack run a.B --name $NAME") is None
@@ -0,0 +1,132 @@
+"""Test the cached DVC stage graph."""
+import pathlib
+
+import dvc.repo
+import git
+import pytest
+import yaml
+import zntrack
+
+from dask4dvc.utils import graph
+
+
+class CreateData(zntrack.Node):
+    """Create some data."""
+
+    inputs = zntrack.zn.params()
+    output = zntrack.zn.outs()
+
+    def run(self) -> None:
+        """ZnTrack run method."""
+        self.output = self.inputs
+
+
+class InputsToOutputs(zntrack.Node):
+    """Create some data."""
+
+    inputs = zntrack.zn.deps()
+    output = zntrack.zn.outs()
+
+    def run(self) -> None:
+        """ZnTrack run method."""
+        self.output = self.inputs
+
+
+def test_stage_graph_cache(
+    repo_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test that the stage graph is cached until the pipeline changes."""
+    with zntrack.Project(automatic_node_names=True) as project:
+        data = CreateData(inputs=1)
+        InputsToOutputs(inputs=data.output)
+    project.run(repro=False)
+
+    repo = git.Repo()
+    repo.git.add(all=True)
+    repo.index.commit("Initial Commit")
+
+    stage_graph = graph.get_stage_graph(dvc.repo.Repo())
+    assert stage_graph.upstream == {
+        "CreateData": [],
+        "InputsToOutputs": ["CreateData"],
+    }
+    assert stage_graph.params == ["params.yaml"]
+    assert stage_graph.get_steps(["InputsToOutputs"]) == [
+        "CreateData",
+        "InputsToOutputs",
+    ]
+    assert (repo_path / ".dvc" / "tmp" / "dask4dvc" / "graph.json").exists()
+
+    with monkeypatch.context() as m:
+        m.setattr(graph, "collect_stage_graph", None)
+        assert graph.get_stage_graph(dvc.repo.Repo()) == stage_graph
+
+    with zntrack.Project(automatic_node_names=True) as project:
+        data = CreateData(inputs=1)
+        InputsToOutputs(inputs=data.output)
+        CreateData(inputs=2)
+    project.run(repro=False)
+
+    stage_graph = graph.get_stage_graph(dvc.repo.Repo())
+    assert set(stage_graph.upstream) == {"CreateData", "CreateData_1", "InputsToOutputs"}
+
+
+def test_stage_graph_cache_vars(repo_path: pathlib.Path) -> None:
+    """Test that the stage graph is rebuilt when a file read by 'vars' changes."""
+    pathlib.Path("config.json").write_text('{"items": ["a", "b"]}')
+    pathlib.Path("dvc.yaml").write_text(
+        yaml.safe_dump(
+            {
+                "vars": ["config.json"],
+                "stages": {
+                    "echo": {
+                        "foreach": "${items}",
+                        "do": {
+                            "cmd": "echo ${item} > ${item}.txt",
+                            "outs": ["${item}.txt"],
+                        },
+                    }
+                },
+            }
+        )
+    )
+    assert graph.get_vars_files(repo_path, ["dvc.yaml"]) == {"config.json"}
+
+    stage_graph = graph.get_stage_graph(dvc.repo.Repo())
+    assert set(stage_graph.upstream) == {"echo@a", "echo@b"}
+    assert stage_graph.vars == ["config.json"]
+
+    pathlib.Path("config.json").write_text('{"items": ["a", "b", "c"]}')
+    stage_graph = graph.get_stage_graph(dvc.repo.Repo())
+    assert set(stage_graph.upstream) == {"echo@a", "echo@b", "echo@c"}
+
+    pathlib.Path("sub").mkdir()
+    pathlib.Path("sub", "dvc.yaml").write_text(
+        yaml.safe_dump(
+            {"stages": {"s": {"wdir": "..", "vars": ["other.yaml:key"], "cmd": "true"}}}
+        )
+    )
+    assert graph.get_vars_files(repo_path, ["sub/dvc.yaml"]) == {"other.yaml"}
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        '{"fingerprint": "abc", "graph": {"upstream": {}',
+        '{"fingerprint": "abc", "graph": {"upstream": {}, "pipeline_stages": []}}',
+        '{"graph": []}',
+    ],
+)
+def test_stage_graph_cache_invalid(repo_path: pathlib.Path, content: str) -> None:
+    """Test that an unreadable cache file is replaced."""
+    pathlib.Path("dvc.yaml").write_text(
+        yaml.safe_dump({"stages": {"echo": {"cmd": "echo a > a.txt", "outs": ["a.txt"]}}})
+    )
+    file = repo_path / ".dvc" / "tmp" / "dask4dvc" / "graph.json"
+    file.parent.mkdir(parents=True)
+    file.write_text(content)
+
+    stage_graph = graph.get_stage_graph(dvc.repo.Repo())
+    assert stage_graph.upstream == {"echo": []}
+    assert list(file.parent.iterdir()) == [file]
+    assert graph.get_stage_graph(dvc.repo.Repo()) == stage_graph
@@ -0,0 +1,39 @@
+"""Test recording the memory usage of stages."""
+import pathlib
+
+import dask.distributed
+
+from dask4dvc.utils.dask import get_memory_resources
+from dask4dvc.utils.memory import _get_memory_file, load_peak_memory, save_peak_memory
+
+
+def test_save_peak_memory(tmp_path: pathlib.Path) -> None:
+    """Test that a broken file is ignored and replaced."""
+    assert load_peak_memory(tmp_path) == {}
+
+    save_peak_memory(tmp_path, "stage", 42)
+    assert load_peak_memory(tmp_path) == {"stage": 42}
+
+    _get_memory_file(tmp_path).write_text('{"stage": 4')
+    assert load_peak_memory(tmp_path) == {}
+
+    save_peak_memory(tmp_path, "other", 7)
+    assert load_peak_memory(tmp_path) == {"other": 7}
+    assert list(_get_memory_file(tmp_path).parent.iterdir()) == [
+        _get_memory_file(tmp_path)
+    ]
+
+
+def test_get_memory_resources() -> None:
+    """Test that the requests are limited to the largest worker."""
+    with dask.distributed.LocalCluster(
+        n_workers=0, processes=False, resources={"memory": 100}
+    ) as cluster, dask.distributed.Client(cluster) as client:
+        # e.g. an adaptive cluster that did not start a worker, yet
+        assert get_memory_resources(client, {"a": 10}, timeout=1) == {}
+
+        cluster.scale(1)
+        assert get_memory_resources(client, {"a": 10, "b": 1000}) == {
+            "a": {"memory": 10},
+            "b": {"memory": 100},
+        }
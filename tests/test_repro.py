@@ -1,14 +1,23 @@
 """Test the 'dask4dvc' CLI."""
+import hashlib
+import os
 import pathlib
 import random
+import typing
 
+import dask.distributed
 import dvc.cli
+import dvc.repo
 import git
 import pytest
+import yaml
 import zntrack
 from typer.testing import CliRunner
 
+from dask4dvc import dvc_repro, dvc_transport
 from dask4dvc.cli.main import app
+from dask4dvc.utils.graph import get_stage_graph
+from dask4dvc.utils.memory import load_peak_memory
 
 runner = CliRunner()
 
@@ -25,6 +34,20 @@ class ReadFile(zntrack.Node):
             self.output = f.read()
 
 
+class LinkedFile(zntrack.Node):
+    """Check how a file was checked out."""
+
+    file: str = zntrack.dvc.deps()
+    output: dict = zntrack.zn.outs()
+
+    def run(self) -> None:
+        """ZnTrack run method."""
+        self.output = {
+            "symlink": os.path.islink(self.file),
+            "hardlink": os.stat(self.file).st_nlink > 1,
+        }
+
+
 class CreateData(zntrack.Node):
     """Create some data."""
 
@@ -207,6 +230,33 @@ def test_multi_complex_graph(repo_path: pathlib.Path) -> None:
     assert result.exit_code == 0
 
 
+@pytest.mark.parametrize("transport", [False, True])
+def test_multi_complex_graph_max_tasks(repo_path: pathlib.Path, transport: bool) -> None:
+    """Test a graph with only one stage submitted at a time."""
+    with zntrack.Project(automatic_node_names=True) as project:
+        data1 = CreateData(inputs=3.1415)
+        data2 = CreateData(inputs=2.7182)
+
+        node1 = InputsToOutputs(inputs=[data1.output, data2.output])
+        node2 = InputsToOutputs(inputs=node1.output)
+        node3 = InputsToOutputs(inputs=[node1.output, node2.output])
+
+    project.run(repro=False)
+
+    repo = git.Repo()
+    repo.git.add(all=True)
+    repo.index.commit("Initial Commit")
+
+    cmd = ["repro", "--max-tasks", "1"]
+    if transport:
+        cmd.append("--transport")
+    result = runner.invoke(app, cmd)
+    assert result.exit_code == 0
+
+    node3.load()
+    assert node3.output == [[3.1415, 2.7182], [3.1415, 2.7182]]
+
+
 @pytest.mark.skip(reason="very slow and no additional coverage")
 def test_massiv_parallel_graph(repo_path: pathlib.Path) -> None:
     """Test a larger graph."""
@@ -226,3 +276,319 @@ def test_massiv_parallel_graph(repo_path: pathlib.Path) -> None:
     for i in range(50):
         io[i].load()
         assert io[i].output == i
+
+
+@pytest.mark.parametrize(
+    ("cache_type", "link"), [("symlink", "symlink"), ("hardlink,symlink", "hardlink")]
+)
+def test_single_node_file_deps_cache_type(
+    repo_path: pathlib.Path, cache_type: str, link: str
+) -> None:
+    """Test repro with linked deps in the experiment workspaces."""
+    with open("test.txt", "w") as f:
+        f.write("Hello World")
+    assert dvc.cli.main(["add", "test.txt"]) == 0
+
+    with zntrack.Project() as project:
+        node = LinkedFile(file="test.txt")
+    project.run(repro=False)
+
+    repo = git.Repo()
+    repo.git.add(all=True)
+    repo.index.commit("Initial Commit")
+
+    result = runner.invoke(app, ["repro", "--cache-type", cache_type])
+    assert result.exit_code == 0
+
+    # the dep was linked in the experiment workspace
+    node.load(lazy=False)
+    assert node.output[link]
+    # the workspace of the user was not changed
+    assert not os.path.islink("test.txt")
+    assert os.stat("test.txt").st_nlink == 1
+
+
+def test_invalid_cache_type(repo_path: pathlib.Path) -> None:
+    """Test that unsupported link types are rejected before queuing."""
+    result = runner.invoke(app, ["repro", "--cache-type", "softlink"])
+    assert result.exit_code == 1
+
+    assert dvc_repro.get_cache_type("symlink") == "symlink,copy"
+    assert dvc_repro.get_cache_type("hardlink,copy") == "hardlink,copy"
+
+
+def test_multi_node_repro_transport(repo_path: pathlib.Path) -> None:
+    """Test repro without a filesystem shared with the workers."""
+    with open("test.txt", "w") as f:
+        f.write("Hello World")
+    assert dvc.cli.main(["add", "test.txt"]) == 0
+
+    with zntrack.Project(automatic_node_names=True) as project:
+        data = ReadFile(file="test.txt")
+        node = InputsToOutputs(inputs=data.output)
+
+    project.run(repro=False)
+
+    repo = git.Repo()
+    repo.git.add(all=True)
+    repo.index.commit("Initial Commit")
+
+    with dask.distributed.LocalCluster(n_workers=2, processes=True) as cluster:
+        result = runner.invoke(
+            app, ["repro", "--transport", "--address", cluster.scheduler_address]
+        )
+    assert result.exit_code == 0
+
+    node.load(lazy=False)
+    assert node.output == "Hello World"
+    # no experiments were queued in the repository
+    assert not pathlib.Path(".dvc", "tmp", "exps").exists()
+
+
+def test_repro_transport_no_run_cache(repo_path: pathlib.Path) -> None:
+    """Test that stages the run cache can not store only run on the workers."""
+    log = repo_path / "runs.log"
+    cmd = f"python -c 'import random; print(random.random())' > r.txt && echo >> {log}"
+    assert dvc.cli.main(["stage", "add", "-n", "rand", "-o", "r.txt", cmd]) == 0
+
+    repo = git.Repo()
+    repo.git.add(all=True)
+    repo.index.commit("Initial Commit")
+
+    with dask.distributed.LocalCluster(n_workers=1, processes=True) as cluster:
+        result = runner.invoke(
+            app, ["repro", "--transport", "--address", cluster.scheduler_address]
+        )
+    assert result.exit_code == 0
+
+    assert len(log.read_text().splitlines()) == 1
+    assert pathlib.Path("r.txt").exists()
+    lock = yaml.safe_load(pathlib.Path("dvc.lock").read_text())
+    assert (
+        lock["stages"]["rand"]["outs"][0]["md5"]
+        == hashlib.md5(pathlib.Path("r.txt").read_bytes()).hexdigest()
+    )
+
+
+def test_repro_transport_known_objects(repo_path: pathlib.Path) -> None:
+    """Test outputs with the same content as files that were sent to the worker."""
+    pathlib.Path("src.txt").write_text("Hello World")
+    assert (
+        dvc.cli.main(
+            [
+                "stage",
+                "add",
+                "-n",
+                "a",
+                "-d",
+                "src.txt",
+                "-o",
+                "a.txt",
+                "cp src.txt a.txt",
+            ]
+        )
+        == 0
+    )
+    assert (
+        dvc.cli.main(
+            ["stage", "add", "-n", "b", "-d", "a.txt", "-o", "b.txt", "cp a.txt b.txt"]
+        )
+        == 0
+    )
+
+    repo = git.Repo()
+    repo.git.add(all=True)
+    repo.index.commit("Initial Commit")
+
+    with dask.distributed.LocalCluster(n_workers=2, processes=True) as cluster:
+        result = runner.invoke(
+            app, ["repro", "--transport", "--address", cluster.scheduler_address]
+        )
+    assert result.exit_code == 0
+
+    assert pathlib.Path("b.txt").read_text() == "Hello World"
+    assert dvc.repo.Repo().status() == {}
+
+
+def test_multi_node_repro_memory_resources(
+    repo_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test that the peak memory is recorded and used as a resource request."""
+    with zntrack.Project(automatic_node_names=True) as project:
+        data = CreateData(inputs=3.1415)
+        node = InputsToOutputs(inputs=data.output)
+
+    project.run(repro=False)
+
+    repo = git.Repo()
+    repo.git.add(all=True)
+    repo.index.commit("Initial Commit")
+
+    result = runner.invoke(app, ["repro"])
+    assert result.exit_code == 0
+
+    peak_memory = load_peak_memory(repo_path)
+    assert set(peak_memory) == {data.name, node.name}
+    assert all(x > 0 for x in peak_memory.values())
+
+    data.inputs = 2.7182
+    project.run(repro=False)
+
+    resources = []
+    submit = dask.distributed.Client.submit
+
+    def record_submit(
+        self: dask.distributed.Client,
+        func: typing.Callable,
+        *args: typing.Any,
+        **kwargs: typing.Any,
+    ) -> dask.distributed.Future:
+        if func is dvc_repro.reproduce_experiment:
+            resources.append(kwargs["resources"])
+        return submit(self, func, *args, **kwargs)
+
+    monkeypatch.setattr(dask.distributed.Client, "submit", record_submit)
+    with dask.distributed.LocalCluster(
+        n_workers=2, processes=True, resources={"memory": 64e9}
+    ) as cluster:
+        result = runner.invoke(
+            app,
+            ["repro", "--memory-resources", "--address", cluster.scheduler_address],
+        )
+    assert result.exit_code == 0
+    assert resources == [
+        {"memory": peak_memory[data.name]},
+        {"memory": peak_memory[node.name]},
+    ]
+
+    node.load()
+    assert node.output == 2.7182
+
+
+@pytest.mark.parametrize("transport", [False, True])
+def test_multi_node_repro_in_process(
+    repo_path: pathlib.Path, transport: bool, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test repro with stages running in processes forked from a forkserver."""
+    with zntrack.Project(automatic_node_names=True) as project:
+        data1 = CreateData(inputs=3.1415)
+        data2 = CreateData(inputs=2.7182)
+
+        node1 = InputsToOutputs(inputs=data1.output)
+        node2 = InputsToOutputs(inputs=data2.output)
+
+    project.run(repro=False)
+
+    repo = git.Repo()
+    repo.git.add(all=True)
+    repo.index.commit("Initial Commit")
+
+    # a 'zntrack' subprocess would fail, the stages must run in the forked process
+    bin_dir = repo_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "zntrack").write_text("#!/bin/sh\nexit 1\n")
+    (bin_dir / "zntrack").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    cmd = ["repro", "--in-process", "--preload", "numpy"]
+    if transport:
+        cmd.append("--transport")
+    result = runner.invoke(app, cmd)
+    assert result.exit_code == 0
+    assert dask.config.get("distributed.worker.daemon")
+
+    node1.load()
+    node2.load()
+
+    assert node1.output == 3.1415
+    assert node2.output == 2.7182
+
+
+@pytest.mark.parametrize("transport", [False, True])
+def test_multi_node_repro_run_cache(
+    repo_path: pathlib.Path, transport: bool, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test that stages are restored from the run cache instead of submitted."""
+
+    def create_project(inputs: float) -> InputsToOutputs:
+        with zntrack.Project(automatic_node_names=True) as project:
+            data = CreateData(inputs=inputs)
+            node = InputsToOutputs(inputs=data.output)
+        project.run(repro=False)
+        return node
+
+    create_project(3.1415)
+    repo = git.Repo()
+    repo.git.add(all=True)
+    repo.index.commit("Initial Commit")
+
+    cmd = ["repro", "--transport"] if transport else ["repro"]
+    assert runner.invoke(app, cmd).exit_code == 0
+    # the results of the workers are in the run cache
+    assert any(pathlib.Path(".dvc", "cache", "runs").iterdir())
+
+    create_project(2.7182)
+    assert runner.invoke(app, cmd).exit_code == 0
+
+    node = create_project(3.1415)
+
+    submitted = []
+    submit = dask.distributed.Client.submit
+
+    def record_submit(
+        self: dask.distributed.Client,
+        func: typing.Callable,
+        *args: typing.Any,
+        **kwargs: typing.Any,
+    ) -> dask.distributed.Future:
+        submitted.append(func)
+        return submit(self, func, *args, **kwargs)
+
+    monkeypatch.setattr(dask.distributed.Client, "submit", record_submit)
+    assert runner.invoke(app, cmd).exit_code == 0
+    assert dvc_repro.reproduce_experiment not in submitted
+    assert dvc_transport.reproduce_stage not in submitted
+
+    node.load()
+    assert node.output == 3.1415
+
+
+def test_load_stages(repo_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that every pipeline file is only parsed once."""
+    pathlib.Path("sub").mkdir()
+    for file in ["dvc.yaml", "sub/dvc.yaml"]:
+        pathlib.Path(file).write_text(
+            yaml.safe_dump(
+                {
+                    "stages": {
+                        "a": {"cmd": "echo a > a.txt", "outs": ["a.txt"]},
+                        "b": {
+                            "foreach": [1, 2],
+                            "do": {"cmd": "echo ${item} > b${item}.txt"},
+                        },
+                    }
+                }
+            )
+        )
+
+    repo = dvc.repo.Repo()
+    loaded_files = []
+    load_file = repo.stage.load_file
+
+    def record_load_file(path: str) -> typing.Any:
+        loaded_files.append(os.path.relpath(path, repo.root_dir))
+        return load_file(path)
+
+    monkeypatch.setattr(repo.stage, "load_file", record_load_file)
+    addressings = ["a", "b@1", "sub/dvc.yaml:a", "sub/dvc.yaml:b@2"]
+    stages = dvc_repro.load_stages(repo, addressings)
+    assert {x: stage.addressing for x, stage in stages.items()} == dict(
+        zip(addressings, addressings)
+    )
+    assert sorted(loaded_files) == ["dvc.yaml", os.path.join("sub", "dvc.yaml")]
+
+    stages = dvc_repro.restore_cached_stages(
+        repo, get_stage_graph(repo), ["sub/dvc.yaml:a", "sub/dvc.yaml:b@1"]
+    )
+    assert stages == ["sub/dvc.yaml:a", "sub/dvc.yaml:b@1"]
+    assert len(loaded_files) == 3
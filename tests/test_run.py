@@ -10,6 +10,7 @@ from typer.testing import CliRunner
 from zntrack.project.zntrack_project import Experiment
 
 from dask4dvc.cli.main import app
+from dask4dvc.utils.dask import wait_for_window
 
 runner = CliRunner()
 
@@ -167,3 +168,35 @@ def test_run_large_queued_experiments(
     for idx, exp in enumerate(large_queued_experiments_repo):
         exp["InputsToOutputs"].output == idx
         exp["InputsToOutputs_1"].output == -idx
+
+
+def test_run_all_experiments_max_tasks(
+    queued_experiments_repo: typing.List[Experiment],
+) -> None:
+    """Test 'dask4dvc run' with only one experiment submitted at a time."""
+    exp1, exp2 = queued_experiments_repo
+    result = runner.invoke(app, ["run", "--max-tasks", "1"])
+    assert result.exit_code == 0
+
+    assert exp1["InputsToOutputs"].output == 3
+    assert exp1["InputsToOutputs_1"].output == 4
+
+    assert exp2["InputsToOutputs"].output == 5
+    assert exp2["InputsToOutputs_1"].output == 6
+
+
+@pytest.mark.parametrize("max_tasks", ["0", "-1"])
+def test_run_invalid_max_tasks(max_tasks: str) -> None:
+    """Test that a window without room for any experiment is rejected."""
+    for cmd in ["run", "repro"]:
+        result = runner.invoke(app, [cmd, "--max-tasks", max_tasks])
+        assert result.exit_code == 2
+
+    with pytest.raises(ValueError):
+        wait_for_window(set(), int(max_tasks))
+
+
+def test_wait_for_window_unlimited() -> None:
+    """Test that the futures are not checked without a window."""
+    futures = {object()}
+    assert wait_for_window(futures, None) == (set(), futures)
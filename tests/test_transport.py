@@ -0,0 +1,43 @@
+"""Test packing files for workers without a shared filesystem."""
+import pathlib
+
+import dask.distributed
+import pytest
+
+from dask4dvc import dvc_transport
+
+
+def test_pack_files_chunks(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test that files larger than a chunk are packed and unpacked."""
+    monkeypatch.setattr(dvc_transport, "CHUNK_SIZE", 16)
+    source, target = tmp_path / "source", tmp_path / "target"
+    (source / "data").mkdir(parents=True)
+    (source / "data" / "a.txt").write_text("Hello World" * 10)
+    (source / "data" / "b.txt").write_text("Hello World" * 10)
+    (source / "c.txt").write_text("")
+
+    files, objects = dvc_transport.pack_files(source, ["data", "c.txt", "missing"])
+    assert sorted(files) == ["c.txt", "data/a.txt", "data/b.txt"]
+    assert len(objects) == 2
+
+    dvc_transport.unpack_files(target, files, objects)
+    assert (target / "data" / "a.txt").read_text() == "Hello World" * 10
+    assert (target / "data" / "b.txt").read_text() == "Hello World" * 10
+    assert (target / "c.txt").read_text() == ""
+
+
+def test_gather_objects(tmp_path: pathlib.Path) -> None:
+    """Test that objects that were scattered before are not packed again."""
+    (tmp_path / "a.txt").write_text("Hello World")
+    (tmp_path / "b.txt").write_text("Hello World")
+    files, objects = dvc_transport.pack_files(tmp_path, ["a.txt"])
+
+    with dask.distributed.Client(processes=False, n_workers=1) as client:
+        scattered = dvc_transport.scatter_objects(client, objects)
+        out_files, out_objects = dvc_transport.pack_files(
+            tmp_path, ["b.txt"], known=scattered
+        )
+        assert out_objects == {}
+        assert dvc_transport.gather_objects(client, out_files, out_objects) == objects